@@ -24,7 +24,7 @@
 #include "Adafruit_TCS34725.h"
 #include <ArduinoSort.h>
 
-String version = "1.1.0";
+String version = "1.2.0";
 
 // change to match the pins used on your controller
 int PhotoresistorPin = 0;  // the photoresistor and 10K pulldown are connected this pin
@@ -56,6 +56,11 @@ uint16_t sensorValues[AS726x_NUM_CHANNELS];
 bool AS726xStarted = false;
 bool TCS34725Started = false;
 
+// set by the subscribe command. While subscribed the indicator is checked continuously and the status is sent
+// whenever it changes
+bool Subscribed = false;
+String LastState = "";
+
 
 //Adafruit_TCS34725 tcs = Adafruit_TCS34725();
 Adafruit_TCS34725 tcs = Adafruit_TCS34725(TCS34725_INTEGRATIONTIME_614MS, TCS34725_GAIN_1X);
@@ -79,7 +84,8 @@ void setup(void) {
   }
 }
 
-void indicatorStatus(bool verbose) {
+// check the device indicator and return the status line to report
+String indicatorStatus(bool verbose) {
   if (SensorType == "photoresistor") {
     int photocellReading;
     int photoStatus[NumberOfChecks];
@@ -99,23 +105,22 @@ void indicatorStatus(bool verbose) {
     sortArray(photoStatus, NumberOfChecks);
     if ((photoStatus[NumberOfChecks - 1] - photoStatus[0]) > BlinkDiff) {
       // assume a difference of more than BlinkDiff between highest and lowest states means the sensor detected blinking
-      Serial.println("Indicator Blinking");
+      return "Indicator Blinking";
     }
 
     else if (photoStatus[0] < LowerLimit) {
-      Serial.println("Indicator Off");
+      return "Indicator Off";
     }
 
     else {
-      Serial.println("Indicator On");
+      return "Indicator On";
     }
 
   }
 
   else if (SensorType == "as726x") {
     if (!AS726xStarted) {
-      Serial.println("ERROR: Cannot connect to AS726x sensor");
-      return;
+      return "ERROR: Cannot connect to AS726x sensor";
     }
 
     // check sensor
@@ -129,8 +134,7 @@ void indicatorStatus(bool verbose) {
         rdy = ams.dataReady();
         // prevent inf loop due to sensor issues
         if (notReadyCount > 10000) {
-          Serial.println("Error: AS726x sensor is not returning data");
-          return;
+          return "Error: AS726x sensor is not returning data";
         }
       }
       ams.readRawValues(sensorValues);
@@ -167,23 +171,22 @@ void indicatorStatus(bool verbose) {
     sortArray(sensorAvg, NumberOfChecks);
     if ((sensorAvg[NumberOfChecks - 1] - sensorAvg[0]) > BlinkDiff) {
       // assume a difference of more than BlinkDiff between highest and lowest states means the sensor detected blinking
-      Serial.println("Indicator Blinking: R:" + String(asReadings[highestReading[1]][0]) + "|O:" + String(asReadings[highestReading[1]][1]) + "|Y:" + String(asReadings[highestReading[1]][2]) + "|G:" + String(asReadings[highestReading[1]][3]) + "|B:" + String(asReadings[highestReading[1]][4]) + "|V:" + String(asReadings[highestReading[1]][5]));
+      return "Indicator Blinking: R:" + String(asReadings[highestReading[1]][0]) + "|O:" + String(asReadings[highestReading[1]][1]) + "|Y:" + String(asReadings[highestReading[1]][2]) + "|G:" + String(asReadings[highestReading[1]][3]) + "|B:" + String(asReadings[highestReading[1]][4]) + "|V:" + String(asReadings[highestReading[1]][5]);
     }
 
     else if (sensorAvg[0] < LowerLimit) {
-      Serial.println("Indicator Off");
+      return "Indicator Off";
     }
 
     else {
       // also send colors for client to parse. Just send first reading
-      Serial.println("Indicator On: R:" + String(asReadings[0][0]) + "|O:" + String(asReadings[0][1]) + "|Y:" + String(asReadings[0][2]) + "|G:" + String(asReadings[0][3]) + "|B:" + String(asReadings[0][4]) + "|V:" + String(asReadings[0][5]));
+      return "Indicator On: R:" + String(asReadings[0][0]) + "|O:" + String(asReadings[0][1]) + "|Y:" + String(asReadings[0][2]) + "|G:" + String(asReadings[0][3]) + "|B:" + String(asReadings[0][4]) + "|V:" + String(asReadings[0][5]);
     }
   }
 
   else if (SensorType == "tcs34725") {
     if (!TCS34725Started) {
-      Serial.println("ERROR: Cannot connect to TCS34725 sensor");
-      return;
+      return "ERROR: Cannot connect to TCS34725 sensor";
     }
 
     // check sensor
@@ -228,41 +231,65 @@ void indicatorStatus(bool verbose) {
     sortArray(sensorAvg, NumberOfChecks);
     if ((sensorAvg[NumberOfChecks - 1] - sensorAvg[0]) > BlinkDiff) {
       // assume a difference of more than BlinkDiff between highest and lowest states means the sensor detected blinking
-      Serial.println("Indicator Blinking: R:" + String(asReadings[highestReading[1]][0]) + "|G:" + String(asReadings[highestReading[1]][1]) + "|B:" + String(asReadings[highestReading[1]][2]));
+      return "Indicator Blinking: R:" + String(asReadings[highestReading[1]][0]) + "|G:" + String(asReadings[highestReading[1]][1]) + "|B:" + String(asReadings[highestReading[1]][2]);
     }
 
     else if (sensorAvg[0] < LowerLimit) {
-      Serial.println("Indicator Off");
+      return "Indicator Off";
     }
 
     else {
       // also send colors for client to parse. Just send first reading
-      Serial.println("Indicator On: R:" + String(asReadings[0][0]) + "|G:" + String(asReadings[0][1]) + "|B:" + String(asReadings[0][2]));
+      return "Indicator On: R:" + String(asReadings[0][0]) + "|G:" + String(asReadings[0][1]) + "|B:" + String(asReadings[0][2]);
     }
   }
 
   else {
-    Serial.println("Error: Invalid sensor type configured!");
+    return "Error: Invalid sensor type configured!";
   }
 }
 
 void loop(void) {
 
   while (!Serial.available()) {
-    // do nothing until serial input is given
+    // do nothing until serial input is given, unless a client is subscribed to status changes
+    if (Subscribed) {
+      String status = indicatorStatus(false);
+      // only compare the state, not the color readings that follow it
+      int sep = status.indexOf(':');
+      String state = sep < 0 ? status : status.substring(0, sep);
+      if (state != LastState) {
+        LastState = state;
+        Serial.println(status);
+        Serial.write(0x04);
+      }
+    }
   }
   String serInput = Serial.readString();
   serInput.toLowerCase();
   serInput.trim();
 
-  if (serInput.startsWith("status")) {
+  if (Subscribed) {
+    // any input ends the subscription
+    Subscribed = false;
+    Serial.println("Unsubscribed");
+  }
+
+  else if (serInput.startsWith("status")) {
     if (serInput.endsWith("verbose")) {
-      indicatorStatus(true);
+      Serial.println(indicatorStatus(true));
     } else {
-      indicatorStatus(false);
+      Serial.println(indicatorStatus(false));
     }
   }
 
+  else if (serInput == "subscribe") {
+    // the first status is always sent, after that only changes are sent. Each is terminated with EOT
+    Subscribed = true;
+    LastState = "";
+    return;
+  }
+
   else if (serInput == "reboot") {
     Serial.print("Rebooting Device ");
     digitalWrite(RelayPin, HIGH);
@@ -289,6 +316,7 @@ void loop(void) {
     Serial.println("settings       - Show set values");
     Serial.println("status         - Show status of device indicator");
     Serial.println("status verbose - Show status of device indicator and report each measurement");
+    Serial.println("subscribe      - Send status of device indicator whenever it changes until any input is given");
     Serial.println("reboot         - Reboot attached device");
     Serial.println("help           - Print this menu");
     Serial.println("version        - Print the firmware version");
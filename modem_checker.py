@@ -6,15 +6,22 @@
 # Python3 is required. See older versions for python2 support.  
 
 import argparse
+import asyncio
+import atexit
+import concurrent.futures
 import datetime
+import functools
+import json
 import logging
 import os
+import queue
 import re
+import socket
 import subprocess
 import sys
 import time
 import traceback
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 # pyserial
 import serial
@@ -26,15 +33,24 @@ serDev = '/dev/cuaU0'
 #serDev = "/dev/ttyACM0"
 
 # some micro controllers reset on serial connect and need a delay before the controller boots and will respond.
-# set to 0 to have no delay, otherwise the number of seconds to wait
+# set to 0 to have no delay, otherwise the max number of seconds to wait. The controller is probed while waiting so
+# commands are issued as soon as it responds
 serConnectDelay = 3
 
 # number of seconds to timeout when waiting for serial response. This must be higher than
 #  RebootDelay in Device Indicator Checker firmware
 serialTimeout = 60
 
-# external hosts to test against
-hosts_to_ping = ['google.com', '4.2.2.2', '1.1.1.1']
+# external hosts to test against. IPs are listed first as they don't need a dns lookup
+hosts_to_ping = ('1.1.1.1', '4.2.2.2', 'google.com')
+
+# number of single packet pings to send to a host before considering it down, and seconds to wait between them
+ping_attempts = 2
+ping_retry_delay = 0.5
+
+# path to fping, used to ping all external hosts with a single process. Falls back to ping if fping is not installed.
+# Set to None to always use ping
+fping_path = '/usr/local/sbin/fping'
 
 # ip of internal gateway. Set to None if this is running on your gateway.
 internal_gw = None
@@ -51,6 +67,11 @@ modem_post_restart_check_delay = 60
 # send email alert after restarting modem?
 send_email = True
 
+# file used to cache the firmware version reported by the microcontroller and how long the cached version is valid
+# for in seconds. Set fw_cache_path to None to always query the microcontroller
+fw_cache_path = '/var/run/modem_checker.cache'
+fw_cache_ttl = 3600
+
 logPath = "/var/log"
 logName = "modem_checker"
 #######################################################################
@@ -90,9 +111,22 @@ VERSION = '1.0.2'
 # min version supported
 MIN_ARDUINO_FW_VERSION = '1.0.2'
 
+# min version that supports the subscribe command. Older versions are polled with the status command
+SUBSCRIBE_MIN_ARDUINO_FW_VERSION = '1.2.0'
+
+# parsed versions of the above so they are only parsed once
+MIN_ARDUINO_FW_PARSED_VERSION = version.parse(MIN_ARDUINO_FW_VERSION)
+SUBSCRIBE_MIN_ARDUINO_FW_PARSED_VERSION = version.parse(SUBSCRIBE_MIN_ARDUINO_FW_VERSION)
+
 # this is a end of transmission signal which the pylib uses to know when to stop reading from the port
 SERIAL_TERMINATOR = b'\x04'
-SERIAL_STRIP_STRING = '\r\n\x04'
+SERIAL_STRIP_STRING = b'\r\n\x04'
+
+# firmware version as reported by the microcontroller's version command
+FW_VER_RE = re.compile(r'\d+\.\d+\.\d+')
+
+# fping per host summary line, ie: 1.1.1.1 : xmt/rcv/%loss = 2/2/0%, min/avg/max = 10.1/10.3/10.5
+FPING_SUMMARY_RE = re.compile(r'^(\S+)\s+:\s+xmt/rcv/%loss = (\d+)/(\d+)/')
 
 logFormatter = logging.Formatter("%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger()
@@ -101,23 +135,92 @@ logging.getLogger().setLevel(logging.INFO)
 fileHandler = TimedRotatingFileHandler("{0}/{1}.log".format(logPath, logName), when='midnight', interval=1,
                                        backupCount=10)
 fileHandler.setFormatter(logFormatter)
-#logger.addHandler(fileHandler)
 
 consoleHandler = logging.StreamHandler()
 consoleHandler.setFormatter(logFormatter)
-logger.addHandler(consoleHandler)
+
+# log records are queued and written by a listener thread so logging doesn't block on I/O
+logQueue = queue.Queue(-1)
+logger.addHandler(QueueHandler(logQueue))
+logListener = QueueListener(logQueue, consoleHandler)
+#logListener = QueueListener(logQueue, consoleHandler, fileHandler)
 
 
 def _convert_serial_data_to_string(data):
     """
-    Convert the bytes object to string.
+    Convert the bytes object to string. The framing is stripped before decoding, and the microcontroller only sends
+    ascii.
     :param data: bytes object
     :return: string
     """
-    data = data.decode()
-    return data.strip(SERIAL_STRIP_STRING)
+    return data.strip(SERIAL_STRIP_STRING).decode('ascii', errors='replace')
+
+
+def _serial_deadline(deadline=None):
+    """
+    Get the deadline for a serial response, which is serialTimeout seconds from now unless the caller has a sooner one
+    :param deadline: time.monotonic() value the caller must be done by
+    :return: time.monotonic() value
+    """
+    default_deadline = time.monotonic() + serialTimeout
+    if deadline is None:
+        return default_deadline
+    return min(deadline, default_deadline)
+
+
+def _read_until_deadline(serial_con, terminator, deadline):
+    """
+    Read from the serial connection until the terminator is received or the deadline passes. This polls for waiting
+    data instead of blocking in read_until so the deadline is honored and ctrl-c is handled promptly. The returned data
+    can contain bytes received after the terminator.
+    :param serial_con: serial connection
+    :param terminator: bytes that end a response
+    :param deadline: time.monotonic() value to stop reading at
+    :return: bytes object
+    """
+    data = bytearray()
+    while terminator not in data:
+        waiting = serial_con.in_waiting
+        if waiting:
+            data += serial_con.read(waiting)
+            continue
+
+        if time.monotonic() > deadline:
+            logger.debug('Timed out waiting for a complete response from the microcontroller')
+            break
+        time.sleep(0.05)
+
+    return bytes(data)
+
+
+def _serial_cmd(serial_con, cmd, deadline=None):
+    """
+    Send a command to the microcontroller and read the response
+    :param serial_con: serial connection
+    :param cmd: command as a bytes object
+    :param deadline: time.monotonic() value to stop waiting for a response at. Defaults to serialTimeout from now
+    :return: string
+    :raises serial.SerialTimeoutException: if nothing was received before the deadline
+    """
+    start = time.monotonic()
+    serial_con.write(cmd)
+    data = _read_until_deadline(serial_con, SERIAL_TERMINATOR, _serial_deadline(deadline))
+    logger.debug('Serial command {c} took {t:.2f}s'.format(c=cmd, t=time.monotonic() - start))
+
+    # only the first frame is the response to this command. anything after it is a late or unexpected reply
+    data, _, extra = data.partition(SERIAL_TERMINATOR)
+    if extra:
+        logger.warning('Discarding {n} unexpected bytes received after the response to serial command {c}: '
+                       '{e!r}'.format(n=len(extra), c=cmd, e=extra))
+
+    resp = _convert_serial_data_to_string(data)
+    if not resp:
+        raise serial.SerialTimeoutException('No response to serial command {c}'.format(c=cmd))
 
+    return resp
 
+
+@functools.lru_cache(maxsize=8)
 def check_min_version(reported_fw_ver):
     """
     Check firmware min version requirement
@@ -126,21 +229,20 @@ def check_min_version(reported_fw_ver):
     :return: True if requirement is met, otherwise false
     :rtype: bool
     """
-    if not reported_fw_ver or version.parse(reported_fw_ver) < version.parse(MIN_ARDUINO_FW_VERSION):
+    if not reported_fw_ver or version.parse(reported_fw_ver) < MIN_ARDUINO_FW_PARSED_VERSION:
         return False
     else:
         return True
 
 
-def get_status(serial_con):
+def get_status(serial_con, deadline=None):
     """
     Get indicator status
     :param serial_con: serial connection
+    :param deadline: time.monotonic() value to stop waiting for a response at. Defaults to serialTimeout from now
     :return: string
     """
-    serial_con.write(b'status')
-    status = serial_con.read_until(expected=SERIAL_TERMINATOR)
-    return _convert_serial_data_to_string(status)
+    return _serial_cmd(serial_con, b'status', deadline)
 
 
 def get_settings(serial_con):
@@ -149,9 +251,7 @@ def get_settings(serial_con):
     :param serial_con: serial connection
     :return: string
     """
-    serial_con.write(b'settings')
-    status = serial_con.read_until(expected=SERIAL_TERMINATOR)
-    return _convert_serial_data_to_string(status)
+    return _serial_cmd(serial_con, b'settings')
 
 
 def get_fw_version(serial_con):
@@ -160,11 +260,14 @@ def get_fw_version(serial_con):
     :param serial_con: serial connection
     :return: string
     """
-    serial_con.write(b'version')
-    status = serial_con.read_until(expected=SERIAL_TERMINATOR)
-    ver_str = _convert_serial_data_to_string(status)
+    try:
+        ver_str = _serial_cmd(serial_con, b'version')
+    except serial.SerialTimeoutException as err:
+        logger.warning(err)
+        return None
+
     # strip everything but the version
-    ver_str = re.search('\d+\.\d+\.\d+', ver_str)
+    ver_str = FW_VER_RE.search(ver_str)
     if not ver_str:
         logger.warning('No valid firmware version was reported')
         return None
@@ -172,15 +275,115 @@ def get_fw_version(serial_con):
         return ver_str[0]
 
 
+def wait_for_controller_boot(serial_con):
+    """
+    Wait for the microcontroller to finish booting by probing it for its firmware version, for up to serConnectDelay
+    seconds.
+    :param serial_con: serial connection
+    :return: firmware version, or None if the microcontroller did not respond
+    """
+    # the firmware waits for input to pause for 1 sec before handling a command, so give each probe time to be answered
+    reply_delay = 1
+    probe_time = 1.5
+    start = time.monotonic()
+    deadline = start + serConnectDelay
+    last_probe = None
+    # probes are sent at fixed offsets from the start, as long as the reply can arrive before the deadline. An
+    # unanswered probe would be merged with the next command, so each gets a full probe_time before the next is sent
+    probe_offset = 0
+    while probe_offset + reply_delay <= serConnectDelay:
+        wait = start + probe_offset - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        last_probe = time.monotonic()
+        try:
+            ver_str = FW_VER_RE.search(_serial_cmd(serial_con, b'version', last_probe + probe_time))
+            if ver_str:
+                return ver_str[0]
+        except serial.SerialTimeoutException:
+            pass
+        probe_offset += probe_time
+
+    # wait out the rest of the delay like a plain sleep would
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+    if last_probe is not None:
+        # make sure the firmware is idle and has answered the last probe, then drop the late reply so it isn't read as
+        # the response to the next command
+        idle_wait = last_probe + probe_time - time.monotonic()
+        if idle_wait > 0:
+            time.sleep(idle_wait)
+        serial_con.reset_input_buffer()
+
+    return None
+
+
+def get_cached_fw_version():
+    """
+    Get the firmware version cached by a previous run for this serial device
+    :return: string or None if there is no valid cached version
+    """
+    if not fw_cache_path:
+        return None
+
+    try:
+        with open(fw_cache_path) as f:
+            cache = json.load(f)
+        entry = cache[serDev]
+        fw_version = entry['fw']
+        if not isinstance(fw_version, str) or not FW_VER_RE.fullmatch(fw_version):
+            logger.debug('Ignoring invalid cached firmware version: {v!r}'.format(v=fw_version))
+        elif time.time() - entry['ts'] < fw_cache_ttl:
+            return fw_version
+
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logger.debug('No usable firmware version cache: {e}'.format(e=err))
+
+    return None
+
+
+def cache_fw_version(fw_version):
+    """
+    Cache the firmware version for this serial device
+    :param fw_version: firmware version reported by the microcontroller
+    :return: None
+    """
+    if not fw_cache_path:
+        return
+
+    try:
+        with open(fw_cache_path) as f:
+            cache = json.load(f)
+        if not isinstance(cache, dict):
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+
+    cache[serDev] = {'fw': fw_version, 'ts': time.time()}
+    try:
+        with open(fw_cache_path, 'w') as f:
+            json.dump(cache, f)
+    except OSError as err:
+        logger.warning('Could not write firmware version cache {p}: {e}'.format(p=fw_cache_path, e=err))
+
+    return
+
+
 def reboot_device(serial_con):
     """
     Send reboot command
     :param serial_con: serial connection
     :return: bool
     """
-    serial_con.write(b'reboot')
-    status = serial_con.read_until(expected=SERIAL_TERMINATOR)
-    status = _convert_serial_data_to_string(status)
+    try:
+        status = _serial_cmd(serial_con, b'reboot')
+    except serial.SerialTimeoutException as err:
+        logger.error('Modem did not restart correctly: {e}'.format(e=err))
+        return False
+
     if "Reboot Completed" not in status:
         logger.error('Modem did not restart correctly. Response: ' + status)
         return False
@@ -188,22 +391,120 @@ def reboot_device(serial_con):
     return True
 
 
-def wait_for_modem(serial_con):
+def _wait_for_modem_events(serial_con, deadline):
+    """
+    Subscribe to indicator status changes and wait for the modem to be in a started state.
+    :param serial_con: serial connection
+    :param deadline: time.monotonic() value to stop waiting at
+    :return: bool, or None if the microcontroller does not support subscribing
+    """
+    serial_con.write(b'subscribe')
+    data = bytearray()
+    subscribed = None
+    try:
+        while time.monotonic() < deadline:
+            data += _read_until_deadline(serial_con, SERIAL_TERMINATOR, deadline)
+            # a read can contain several status changes and the start of the next one
+            *events, tail = data.split(SERIAL_TERMINATOR)
+            data = bytearray(tail)
+            for event in events:
+                status = _convert_serial_data_to_string(event)
+                if subscribed is None:
+                    # the first reply is always the current status when subscribing is supported. the firmware version
+                    # may be cached, so the firmware could have been changed and not support it
+                    subscribed = status.startswith('Indicator')
+                    if not subscribed:
+                        logger.warning('Microcontroller did not accept the subscribe command, falling back to polling. '
+                                       'Response: ' + status)
+                        return None
+
+                logger.debug('Modem indicator status is: ' + status)
+                if "Indicator On" in status:
+                    return True
+
+        return False
+
+    finally:
+        if subscribed is not False:
+            _unsubscribe(serial_con)
+
+
+def _unsubscribe(serial_con):
+    """
+    End a status subscription
+    :param serial_con: serial connection
+    :return: None
+    """
+    # any input ends the subscription. discard status changes sent before the microcontroller saw it
+    serial_con.write(b'unsubscribe')
+    unsubscribe_deadline = _serial_deadline()
+    data = _read_until_deadline(serial_con, b'Unsubscribed', unsubscribe_deadline)
+    if b'Unsubscribed' in data and SERIAL_TERMINATOR not in data.split(b'Unsubscribed', 1)[1]:
+        _read_until_deadline(serial_con, SERIAL_TERMINATOR, unsubscribe_deadline)
+
+
+def wait_for_modem(serial_con, fw_version=None):
     """
     Wait for modem to be in a started state.
     :param serial_con: serial connection
-    :param timeout: number of minutes before timing out waiting for modem
+    :param fw_version: firmware version on the microcontroller, used to decide if the status can be subscribed to
     :return: bool
     """
-    timeout_time = datetime.datetime.now() + datetime.timedelta(minutes=modem_restart_timeout)
-
-    while datetime.datetime.now() < timeout_time:
-        status = get_status(serial_con)
+    deadline = time.monotonic() + modem_restart_timeout * 60
+
+    if fw_version and version.parse(fw_version) >= SUBSCRIBE_MIN_ARDUINO_FW_PARSED_VERSION:
+        modem_status = _wait_for_modem_events(serial_con, deadline)
+        if modem_status is not None:
+            return modem_status
+
+    # start polling quickly and back off, as the modem is often up on the first few checks
+    delay = 2
+    while time.monotonic() < deadline:
+        try:
+            status = get_status(serial_con, deadline)
+        except serial.SerialTimeoutException as err:
+            logger.warning(err)
+            status = ''
         logger.debug('Modem indicator status is: ' + status)
         if "Indicator On" in status:
             return True
-        else:
-            time.sleep(10)
+
+        # don't sleep past the timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(15, delay * 2)
+
+    return False
+
+
+async def _ping(host):
+    """
+    Ping a host without blocking the event loop. A single probe is sent and retried once on failure to avoid false
+    negatives from a lost packet.
+    :param host: hostname or ip
+    :return: bool
+    """
+    for attempt in range(ping_attempts):
+        if attempt:
+            await asyncio.sleep(ping_retry_delay)
+
+        # -t is the overall deadline in seconds and is consistent across FreeBSD versions, unlike -W
+        proc = await asyncio.create_subprocess_exec('/sbin/ping', '-c', '1', '-t', '1', host,
+                                                    stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        try:
+            if await proc.wait() == 0:
+                return True
+        except asyncio.CancelledError:
+            # don't leave the ping running if the result is no longer needed
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            raise
 
     return False
 
@@ -214,32 +515,98 @@ def is_host_pingable(host):
     :param host: hostname or ip
     :return: bool
     """
-    resp = os.system("ping -c 3 " + host + "> /dev/null 2>&1")
-    if resp == 0:
-        return True
-    else:
-        return False
+    return asyncio.run(_ping(host))
 
 
-def run_internet_check():
+async def _fping(hosts):
+    """
+    Ping all hosts in parallel with a single fping process
+    :param hosts: list of hostnames or ips
+    :return: dict of host to bool
     """
-    Run ping checks against all external hosts
+    proc = await asyncio.create_subprocess_exec(fping_path, '-c2', '-t500', *hosts,
+                                                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+
+    # fping writes the per host summary to stderr. hosts that could not be resolved won't have a summary line
+    results = dict.fromkeys(hosts, False)
+    for line in stderr.decode(errors='replace').splitlines():
+        m = FPING_SUMMARY_RE.match(line)
+        if m and m.group(1) in results:
+            results[m.group(1)] = int(m.group(3)) > 0
+
+    return results
+
+
+async def run_internet_check():
+    """
+    Run ping checks against all external hosts. fping is used when available, otherwise the pings are run concurrently
+    and the check passes as soon as any host responds.
     :return: bool
     """
-    test_passed = False
-    for host in hosts_to_ping:
-        status = is_host_pingable(host)
+    start = time.monotonic()
+
+    async def check_host(host):
+        status = await _ping(host)
         logger.info('Host {h} is pingable: {a}'.format(h=host, a=status))
-        if status:
-            test_passed = True
-            break
+        logger.debug('Ping check of {h} took {t:.2f}s'.format(h=host, t=time.monotonic() - start))
+        return status
+
+    if fping_path and os.path.exists(fping_path):
+        results = await _fping(hosts_to_ping)
+        logger.debug('fping check took {t:.2f}s'.format(t=time.monotonic() - start))
+        for host, status in results.items():
+            logger.info('Host {h} is pingable: {a}'.format(h=host, a=status))
+        return any(results.values())
+
+    logger.debug('fping is not available, falling back to ping')
+    tasks = [asyncio.ensure_future(check_host(host)) for host in hosts_to_ping]
+    try:
+        for task in asyncio.as_completed(tasks):
+            if await task:
+                return True
+
+        return False
+
+    finally:
+        # no need to wait on the remaining hosts once one has passed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    return test_passed
+
+def _is_link_active(interface):
+    """
+    Check the link state of an interface from ifconfig. This is the carrier state, not the UP flag, which ifconfig sets
+    before returning
+    :param interface: interface name
+    :return: bool
+    """
+    res = subprocess.run(["/sbin/ifconfig", interface], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return 'status: active' in res.stdout.decode(errors='replace')
+
+
+def _wait_for_link_state(interface, want_active, timeout=10):
+    """
+    Wait for the link of an interface to reach a state instead of sleeping for a fixed time
+    :param interface: interface name
+    :param want_active: True to wait for the link to be active, False to wait for it to drop
+    :param timeout: max number of seconds to wait
+    :return: bool, if the state was reached before the timeout
+    """
+    deadline = time.monotonic() + timeout
+    while _is_link_active(interface) != want_active:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+
+    return True
 
 
 def bounce_interface():
     """
-    Bounce external interface.
+    Bounce external interface by setting it down and back up. This doesn't need the modem to be up, so it can run while
+    the modem restarts. linkup_interface must be ran once the modem is up.
     :return: None
     """
     os.setpgrp()
@@ -247,12 +614,26 @@ def bounce_interface():
     if res:
         logger.info('Output from setting interface to down: {o}'.format(o=res))
 
-    time.sleep(10)
+    # wait for the link to drop so the modem sees it go down. this is bounded by the previous fixed delay
+    if not _wait_for_link_state(ext_interface, want_active=False):
+        logger.warning('Timed out waiting for the link on interface {i} to go down'.format(i=ext_interface))
+
     res = subprocess.check_output(["/sbin/ifconfig", ext_interface, "up"], stderr=subprocess.STDOUT)
     if res:
         logger.info('Output from setting interface to up: {o}'.format(o=res))
 
-    time.sleep(10)
+    return
+
+
+def linkup_interface():
+    """
+    Run the pfsense link up actions (dhcp, gateway setup, etc) for the external interface. This should be ran after the
+    modem is up, otherwise the configuration is renewed against a modem that is still restarting.
+    :return: None
+    """
+    if not _wait_for_link_state(ext_interface, want_active=True):
+        logger.warning('Timed out waiting for interface {i} to become active'.format(i=ext_interface))
+
     res = subprocess.check_output(["/etc/rc.linkup", "interface=" + ext_interface, "action=start"],
                                   stderr=subprocess.STDOUT)
     if res:
@@ -289,43 +670,38 @@ def send_email_alert():
     :return: None
     """
     msg = 'Modem was restarted due to internet failure at ' + datetime.datetime.now().replace(microsecond=0).isoformat()
-    os.system('echo ' + msg + ' |/usr/local/bin/mail.php -s"`hostname` - Notification"')
+    subprocess.run(['/usr/local/bin/mail.php', '-s', '{h} - Notification'.format(h=socket.gethostname())],
+                   input=(msg + '\n').encode())
     return
 
 
-def main(serial_con):
+def parse_args():
+    """
+    Parse command line arguments
+    :return: argparse.Namespace
+    """
     parser = argparse.ArgumentParser(description=PROGNAME +
                                                  '\n\nUtility that that checks internet status and restarts a device ' +
                                                  'such as a modem when needed.',
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
     parser.add_argument('-s', '--settings', action='store_true', help='Show controller settings')
-    args = parser.parse_args()
-
-    if args.debug:
-        logging.getLogger().setLevel(logging.DEBUG)
-
-    # ensure firmware supports required features
-    mc_fw_version = get_fw_version(serial_con)
-    if check_min_version(mc_fw_version):
-        logger.debug('Require fw version {min} and found {rep}, checks passed'.format(min=MIN_ARDUINO_FW_VERSION,
-                                                                                      rep=mc_fw_version))
-    else:
-        logger.fatal('Require fw version {min} but found {rep}. Please update the modem checker firmware on the '
-                     'microcontroller.'.format(min=MIN_ARDUINO_FW_VERSION, rep=mc_fw_version))
-        return
+    return parser.parse_args()
 
-    if args.settings:
-        print(get_settings(serial_con))
-        return
 
+def preflight():
+    """
+    Run the internet and internal gateway checks. These don't need the microcontroller, so they are run before the
+    serial port is opened.
+    :return: True if the modem should be restarted, otherwise False
+    """
     logger.info('Starting internet checks')
 
     logger.info('Checking readability of external hosts')
-    internet_status_ok = run_internet_check()
+    internet_status_ok = asyncio.run(run_internet_check())
     if internet_status_ok:
         logger.info('At least one external host is reachable. Considering internet up. Exiting.')
-        return
+        return False
 
     else:
         logger.info('All external host are unreachable. Considering internet down.')
@@ -334,34 +710,78 @@ def main(serial_con):
         logger.info('Checking readability of internal gateway')
         if not is_host_pingable(internal_gw):
             logger.info('Internal gateway is down. Not attempting to restart modem. Exiting.')
-            return
+            return False
         else:
             logger.info('Internal gateway is reachable.')
 
     else:
         logger.info('Internal gateway was not provided, skipping check.')
 
+    return True
+
+
+def main(serial_con, args, mc_fw_version=None):
+    # ensure firmware supports required features. skip asking the microcontroller if it already reported its version
+    # while booting or if a recent run already asked
+    if mc_fw_version:
+        logger.debug('Microcontroller reported fw version {v} while booting'.format(v=mc_fw_version))
+        if check_min_version(mc_fw_version):
+            cache_fw_version(mc_fw_version)
+    else:
+        mc_fw_version = get_cached_fw_version()
+        if check_min_version(mc_fw_version):
+            logger.debug('Using cached fw version {v}'.format(v=mc_fw_version))
+        else:
+            mc_fw_version = get_fw_version(serial_con)
+            if check_min_version(mc_fw_version):
+                cache_fw_version(mc_fw_version)
+
+    if check_min_version(mc_fw_version):
+        logger.debug('Require fw version {min} and found {rep}, checks passed'.format(min=MIN_ARDUINO_FW_VERSION,
+                                                                                      rep=mc_fw_version))
+    else:
+        logger.fatal('Require fw version {min} but found {rep}. Please update the modem checker firmware on the '
+                     'microcontroller.'.format(min=MIN_ARDUINO_FW_VERSION, rep=mc_fw_version))
+        return
+
+    if args.settings:
+        try:
+            print(get_settings(serial_con))
+        except serial.SerialTimeoutException as err:
+            logger.error('Could not get controller settings: {e}'.format(e=err))
+        return
+
     # internet seems down an either internal gateway check passed or was skipped.
     logger.warning('Restarting modem as internet is unreachable')
     reboot_device(serial_con)
 
-    logger.info('Waiting {n} seconds before running modem checks'.format(n=modem_post_restart_check_delay))
-    time.sleep(modem_post_restart_check_delay)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # bounce interface even if the modem doesn't come up. Setting the interface down and up doesn't depend on the
+        # modem state, so do that while waiting on the modem. The link up actions need the modem and are ran after
+        bounce_future = None
+        if ext_interface:
+            logger.info('Bouncing interface')
+            bounce_future = executor.submit(bounce_interface)
+        else:
+            logger.info('Not bouncing interface as no interface was specified')
 
-    logger.info('Modem restart done. Waiting for modem to connect')
-    modem_status = wait_for_modem(serial_con)
+        logger.info('Waiting {n} seconds before running modem checks'.format(n=modem_post_restart_check_delay))
+        time.sleep(modem_post_restart_check_delay)
 
-    if modem_status:
-        logger.info('Modem appears to have come back up')
-    else:
-        logger.error('Timeout hit while waiting for modem to come up')
+        logger.info('Modem restart done. Waiting for modem to connect')
+        modem_status = wait_for_modem(serial_con, mc_fw_version)
 
-    # bounce interface even if the modem didn't come up
-    if ext_interface:
-        logger.info('Bouncing interface')
-        bounce_interface()
-    else:
-        logger.info('Not bouncing interface as no interface was specified')
+        if modem_status:
+            logger.info('Modem appears to have come back up')
+        else:
+            logger.error('Timeout hit while waiting for modem to come up')
+
+        if bounce_future:
+            # re-raises any error from bouncing the interface
+            bounce_future.result()
+            logger.info('Running link up actions for interface')
+            linkup_interface()
+            logger.info('Done bouncing interface')
 
     logger.info('Done preforming resetting')
 
@@ -373,6 +793,24 @@ def main(serial_con):
 
 
 if __name__ == "__main__":
+    logListener.start()
+    # flush queued log records on every exit path
+    atexit.register(logListener.stop)
+
+    args = parse_args()
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    # only open the serial port if the modem needs to be restarted or the controller settings were requested
+    if not args.settings:
+        try:
+            restart_needed = preflight()
+        except Exception:
+            logger.fatal('Unhandled exception in preflight checks: \n{e}'.format(e=str(traceback.format_exc())))
+            restart_needed = False
+
+        if not restart_needed:
+            sys.exit(0)
 
     serial_con = None
     try:
@@ -388,12 +826,14 @@ if __name__ == "__main__":
         close_serial(serial_con)
         sys.exit(1)
 
-    if serConnectDelay and serConnectDelay > 0:
-        logger.debug('Waiting {} sec for arduino to finish booting before issuing commands'.format(serConnectDelay))
-        time.sleep(serConnectDelay)
-
     try:
-        main(serial_con)
+        mc_fw_version = None
+        if serConnectDelay and serConnectDelay > 0:
+            logger.debug('Waiting up to {} sec for arduino to finish booting before issuing commands'.format(
+                serConnectDelay))
+            mc_fw_version = wait_for_controller_boot(serial_con)
+
+        main(serial_con, args, mc_fw_version)
     except Exception:
         logger.fatal('Unhandled exception in main function: \n{e}'.format(e=str(traceback.format_exc())))
 